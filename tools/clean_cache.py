@@ -0,0 +1,147 @@
+#! /usr/bin/env python3
+
+"""Utility to clean up the local cache of charm repositories."""
+
+import asyncio
+import logging
+import os
+import pathlib
+import shutil
+
+import click
+from helpers import configure_logging
+
+logger = logging.getLogger(__name__)
+
+# Folders that the analysis (and charm test) tooling leaves behind, and that
+# can be safely removed - anything that matters can be regenerated.
+JUNK_DIRS = frozenset((
+    ".tox",
+    ".mypy_cache",
+    ".pytest_cache",
+    ".ruff_cache",
+    "__pycache__",
+))
+JUNK_DIR_SUFFIXES = (".egg-info",)
+# Files that the tooling leaves behind that can be safely removed.
+JUNK_FILE_SUFFIXES = (".charm",)
+
+
+def _get_dir_size(path: str):
+    """Total size, in bytes, of all the files in the tree rooted at path.
+
+    Uses a single os.scandir pass per directory: DirEntry caches the dirent
+    type and stat result, avoiding the extra stat syscall per file (and the
+    Path object allocation) that an rglob would cost. `.tox` trees can have
+    tens of thousands of files, so this adds up.
+    """
+    total = 0
+    stack = [str(path)]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    total += entry.stat(follow_symlinks=False).st_size
+    return total
+
+
+def _find_junk(repo: pathlib.Path):
+    """Iterate through the junk in the repository, as (path, is_dir) pairs.
+
+    A single os.walk pass matches every pattern per entry, rather than an
+    independent full-tree rglob per pattern. Matched folders are pruned so we
+    don't pointlessly descend into the junk we're about to remove. Plain
+    os.path strings are used throughout - the walk already knows whether each
+    entry is a folder, so there's no need to build Path objects and re-stat.
+    """
+    for dirpath, dirnames, filenames in os.walk(repo):
+        matched = [
+            name
+            for name in dirnames
+            if name in JUNK_DIRS or name.endswith(JUNK_DIR_SUFFIXES)
+        ]
+        for name in matched:
+            yield os.path.join(dirpath, name), True
+            dirnames.remove(name)
+        for name in filenames:
+            if name.endswith(JUNK_FILE_SUFFIXES):
+                yield os.path.join(dirpath, name), False
+
+
+async def _git_clean(sem: asyncio.Semaphore, repo: pathlib.Path, dry_run: bool):
+    """Run `git clean` in the repository."""
+    async with sem:
+        # In a dry run the "Would remove ..." listing on stdout is the whole
+        # point, so capture it; otherwise it's just noise to discard.
+        clean = await asyncio.create_subprocess_exec(
+            "git",
+            "clean",
+            "-fdxn" if dry_run else "-fdx",
+            cwd=repo,
+            stdout=asyncio.subprocess.PIPE if dry_run else asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        stdout, _ = await clean.communicate()
+        if clean.returncode != 0:
+            logger.warning("`git clean` failed in %s", repo)
+        elif dry_run and stdout:
+            logger.info("`git clean` in %s:\n%s", repo, stdout.decode().strip())
+
+
+async def _git_clean_all(repos: list[pathlib.Path], dry_run: bool):
+    """Run `git clean` concurrently in each of the repositories.
+
+    Each clean is I/O bound, so running them concurrently (bounded, as in
+    get_charms.py) is far faster than one at a time.
+    """
+    sem = asyncio.Semaphore(16)
+    async with asyncio.TaskGroup() as tg:
+        for repo in repos:
+            tg.create_task(_git_clean(sem, repo, dry_run))
+
+
+@click.option("--cache-folder", default=".cache")
+@click.option("--dry-run/--no-dry-run", default=False)
+@click.option("--git-clean/--no-git-clean", default=False)
+@click.command()
+def main(cache_folder: str, dry_run: bool, git_clean: bool):
+    """Remove files generated by the analysis tools from the cached repositories.
+
+    Removes well-known junk folders (tox and linter caches, packed charms,
+    and so on), and optionally also runs `git clean` in each repository to
+    get back to a pristine checkout.
+    """
+    configure_logging()
+
+    reclaimed = 0
+    repos = []
+    for repo in pathlib.Path(cache_folder).iterdir():
+        if repo.name.startswith(".") or not repo.is_dir():
+            continue
+        # Collect everything up-front: removing a folder while the walk is
+        # still in progress would be unpleasant.
+        for junk, is_dir in list(_find_junk(repo)):
+            if not os.path.exists(junk):
+                # Contained in a folder that has already been removed.
+                continue
+            size = _get_dir_size(junk) if is_dir else os.stat(junk).st_size
+            reclaimed += size
+            logger.info("Removing %s (%.1f MiB)", junk, size / 1048576)
+            if dry_run:
+                continue
+            if is_dir:
+                shutil.rmtree(junk)
+            else:
+                os.unlink(junk)
+        repos.append(repo)
+    if git_clean:
+        asyncio.run(_git_clean_all(repos, dry_run))
+    logger.info(
+        "%s %.1f MiB", "Would reclaim" if dry_run else "Reclaimed", reclaimed / 1048576
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,112 @@
 """Utilities common across multiple tools."""
 
+import functools
 import itertools
+import json
 import logging
+import os
 import pathlib
 
-import rich.table
-import yaml
+# rich and yaml are comparatively expensive to import, so they are imported
+# lazily in the functions that need them, keeping tool start-up (--help,
+# argument errors, and so on) fast.
+
+__all__ = [
+    "configure_logging",
+    "count_and_percentage_table",
+    "iter_entries",
+    "iter_python_src",
+    "iter_repositories",
+    "load_yaml",
+]
 
 logger = logging.getLogger(__name__)
 
 
+def configure_logging(level: int = logging.INFO):
+    """Set up logging in the way that all of the tools want it."""
+    import rich.logging
+
+    logging.basicConfig(
+        level=level,
+        format="%(message)s",
+        datefmt="[%X]",
+        handlers=[rich.logging.RichHandler()],
+    )
+
+
+# Bounded so that a run over thousands of repositories doesn't hold every
+# parsed document live until exit - repeat loads of the same file happen
+# close together, so a modest cache keeps the hit rate.
+@functools.lru_cache(maxsize=1024)
+def _cached_yaml_load(path: str, mtime_ns: int):
+    import yaml
+
+    # Prefer the libyaml loader; without it parsing is 5-10x slower, but
+    # still correct.
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    with open(path) as raw:
+        return yaml.load(raw, Loader=loader)
+
+
+def load_yaml(path: pathlib.Path):
+    """Parse a YAML file, caching the result.
+
+    Several tools parse the same metadata/charmcraft files (and some parse
+    them more than once per run), so memoise by path and mtime.
+    """
+    return _cached_yaml_load(str(path), path.stat().st_mtime_ns)
+
+
+def _dir_names(path: str | pathlib.Path):
+    """The set of entry names directly inside the folder.
+
+    A single scandir (one readdir) replaces a stat syscall per `.exists()`
+    probe against the folder's contents.
+    """
+    try:
+        with os.scandir(path) as entries:
+            return {entry.name for entry in entries}
+    except (FileNotFoundError, NotADirectoryError):
+        return set()
+
+
 def _iter_monorepo(base: pathlib.Path):
     """Iterate through each of the charms contained in a single repository."""
-    for repo in pathlib.Path(base).iterdir():
-        if repo.name.startswith("."):
-            continue
+    # Work with the raw scandir strings, only building Path objects for the
+    # entries that are actually yielded. Test the (free) name prefix before
+    # the dirent type, and the type before opening the child folder - plain
+    # files like README.md get no syscalls at all.
+    with os.scandir(base) as entries:
+        children = [
+            e.path
+            for e in entries
+            if not e.name.startswith(".") and e.is_dir(follow_symlinks=False)
+        ]
+    for child in children:
+        names = _dir_names(child)
         # We don't have a marker for "monorepo of charms", as we do with a
         # bundle, and we don't want to manually mark entries as monorepos, so
         # we have to use a heuristic here to decide if this is a monorepo.
         # For now, we'll assume that if there is either a "metadata.yaml" or
         # "charmcraft.yaml" file inside of the subfolder, then it's a charm.
-        if (repo / "charmcraft.yaml").exists() or (repo / "metadata.yaml").exists():
-            logger.info("Found %s in presumed monorepo %s", repo.name, base)
-            yield repo
+        if "charmcraft.yaml" in names or "metadata.yaml" in names:
+            logger.info(
+                "Found %s in presumed monorepo %s", os.path.basename(child), base
+            )
+            yield pathlib.Path(child)
         # We'll also look for "bundle.yaml" in case there's a bundle inside of
         # a monorepo.
-        if (repo / "bundle.yaml").exists():
-            logger.info("Found bundle %s in presumed monorepo %s", repo.name, base)
-            yield from _iter_bundles(repo)
+        if "bundle.yaml" in names:
+            logger.info(
+                "Found bundle %s in presumed monorepo %s", os.path.basename(child), base
+            )
+            yield from _iter_bundles(pathlib.Path(child))
 
 
 def _iter_non_monorepo(base: pathlib.Path):
     """Iterate through charms in the top level folder."""
-    if (base / "bundle.yaml").exists():
+    if "bundle.yaml" in _dir_names(base):
         yield from _iter_bundles(base)
     else:
         yield base
@@ -41,48 +115,120 @@ def _iter_non_monorepo(base: pathlib.Path):
 def _iter_bundles(base: pathlib.Path):
     """Automatically traverse the charms in a bundle."""
     logger.info("Unbundling %s", base)
-    yield from (base / "charms").iterdir()
-
-
-def iter_repositories(base: pathlib.Path):
-    """Iterate through all the charm folders contained in the base location."""
-    sources = itertools.chain(_iter_non_monorepo(base), _iter_monorepo(base))
+    # The dirent type is cached by scandir, so skipping non-charm entries
+    # here costs no extra syscalls.
+    with os.scandir(base / "charms") as entries:
+        for entry in entries:
+            if entry.name.startswith(".") or not entry.is_dir(follow_symlinks=False):
+                continue
+            yield pathlib.Path(entry.path)
+
+
+def _scan_repositories(base: pathlib.Path):
+    """Scan the filesystem to build the index of the cache's shape."""
+    repos = []
+    # Yield in sorted order: successive tools iterate the same set, so a
+    # stable order means the second tool hits a warm dentry/page cache.
+    sources = sorted(
+        itertools.chain(_iter_non_monorepo(base), _iter_monorepo(base)),
+        key=os.fspath,
+    )
     for repo in sources:
-        if (repo / "reactive").exists():
+        names = _dir_names(repo)
+        if "reactive" in names:
             logger.info("Ignoring reactive charm: %s", repo)
             continue
-        elif (repo / "hooks").exists():
+        elif "hooks" in names:
             logger.info("Ignoring hook charm: %s", repo)
             continue
-        yield repo
+        entry = "src/charm.py"
+        if "charmcraft.yaml" in names:
+            data = load_yaml(repo / "charmcraft.yaml")
+            # For now, (wrongly) assume all the code is in the entrypoint module.
+            try:
+                entry = data["parts"]["charm"]["charm-entrypoint"]
+            except KeyError:
+                pass
+        repos.append({
+            "path": str(repo),
+            "entrypoint": entry,
+            "entrypoint_exists": (repo / entry).exists(),
+        })
+    return repos
+
+
+@functools.lru_cache(maxsize=None)
+def _load_index(base: pathlib.Path):
+    """The per-repository shape of the cache, persisted between runs.
+
+    Every tool re-derives the same facts about the cache (which folders are
+    charms, where the entrypoints are), so store them in an index file inside
+    the cache, keyed on the cache folder's mtime. That invalidates whenever a
+    repository is added or removed - a `touch` of the cache folder forces a
+    rescan after anything subtler.
+    """
+    index_path = base / ".tools_index.json"
+    try:
+        key = base.stat().st_mtime_ns
+    except FileNotFoundError:
+        return []
+    try:
+        with index_path.open() as raw:
+            index = json.load(raw)
+        if index["key"] == key:
+            return index["repos"]
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        pass
+    repos = _scan_repositories(base)
+    try:
+        # Creating the index file bumps the folder's mtime, so make sure it
+        # exists before the key is computed (overwrites don't change it).
+        index_path.touch()
+        with index_path.open("w") as raw:
+            json.dump({"key": base.stat().st_mtime_ns, "repos": repos}, raw)
+    except OSError:
+        logger.debug("Unable to store the index in %s", index_path)
+    return repos
+
+
+def iter_repositories(base: pathlib.Path):
+    """Iterate through all the charm folders contained in the base location."""
+    for repo in _load_index(pathlib.Path(base)):
+        yield pathlib.Path(repo["path"])
 
 
 def iter_entries(base: pathlib.Path):
     """Iterate through all the charm entry points contained in the base location."""
-    for repo in iter_repositories(base):
-        entry = "src/charm.py"
-        if (repo / "charmcraft.yaml").exists():
-            with (repo / "charmcraft.yaml").open() as charmcraft:
-                data = yaml.safe_load(charmcraft)
-                # For now, (wrongly) assume all the code is in the entrypoint module.
-                try:
-                    entry = data["parts"]["charm"]["charm-entrypoint"]
-                except KeyError:
-                    pass
-        if not (repo / entry).exists():
-            logger.warning("Unable to find entrypoint for %s (guessed %s).", repo, entry)
+    for repo in _load_index(pathlib.Path(base)):
+        if not repo["entrypoint_exists"]:
+            logger.warning(
+                "Unable to find entrypoint for %s (guessed %s).",
+                repo["path"],
+                repo["entrypoint"],
+            )
             continue
-        yield (repo / entry)
+        yield pathlib.Path(repo["path"]) / repo["entrypoint"]
 
 
 def iter_python_src(base: pathlib.Path):
     """Iterate through all the Python modules contained a 'src' folder in the base location."""
     for repo in iter_repositories(base):
-        yield from repo.glob("src/**/*.py")
+        src = repo / "src"
+        if not src.is_dir():
+            continue
+        # os.fwalk works relative to an open directory fd, so the kernel
+        # doesn't re-resolve the full path for every entry the way a
+        # recursive glob does.
+        for dirpath, _, filenames, _ in os.fwalk(src):
+            for name in filenames:
+                if name.endswith(".py"):
+                    yield pathlib.Path(dirpath, name)
 
 
 def count_and_percentage_table(title, col0_title, total, counts):
     """Return a rich.table.Table that has a count and percentage columns."""
+    import rich.table
+
     table = rich.table.Table(title=title)
     table.add_column(col0_title)
     table.add_column("Count")
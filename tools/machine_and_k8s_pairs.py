@@ -0,0 +1,36 @@
+#! /usr/bin/env python3
+
+"""List the charms that have both a machine and a Kubernetes variant."""
+
+import pathlib
+
+import click
+from helpers import configure_logging
+from helpers import iter_repositories
+
+
+@click.option("--cache-folder", default=".cache")
+@click.command()
+def main(cache_folder: str):
+    """Output the names of the charms that come in machine and k8s pairs.
+
+    Assumes the usual naming convention: the Kubernetes variant of a charm
+    has a "-k8s" suffix (before any "-operator" suffix).
+    """
+    configure_logging()
+
+    names = set()
+    k8s_names = set()
+    for repo in iter_repositories(pathlib.Path(cache_folder)):
+        name = repo.name.removesuffix("-operator")
+        if name.endswith("-k8s"):
+            k8s_names.add(name.removesuffix("-k8s"))
+        else:
+            names.add(name)
+
+    # The intersection runs in C, and the single join means one write.
+    print("\n".join(sorted(k8s_names & names)))
+
+
+if __name__ == "__main__":
+    main()
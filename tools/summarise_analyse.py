@@ -0,0 +1,280 @@
+#! /usr/bin/env python3
+
+"""Summarise the results of `charmcraft analyse` across a set of charms."""
+
+import asyncio
+import collections
+import hashlib
+import json
+import logging
+import pathlib
+import re
+
+import click
+from helpers import configure_logging
+from helpers import count_and_percentage_table
+from helpers import iter_repositories
+
+logger = logging.getLogger(__name__)
+
+# The format of each `charmcraft analyse` result line.
+_ANALYSE_RE = re.compile(r"(?P<key>[^:]+): \[(?P<result>\w+)\] (?P<detail>.*)")
+# Continuations of the detail of the previous result.
+_CONT_PREFIXES = ("Some config-options", "Some action params")
+# Expected for a few of the charms - not worth reporting.
+_SKIP_PREFIXES = (
+    "language: Charm language unknown",
+    "framework: The charm is not based on any known Framework",
+)
+
+
+def _load_analyse_cache(repo: pathlib.Path):
+    """Load the previously stored analyse results for the repository."""
+    try:
+        with (repo / ".analyse_cache.json").open() as raw:
+            return json.load(raw)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _store_analyse_cache(repo: pathlib.Path, cache: dict):
+    with (repo / ".analyse_cache.json").open("w") as raw:
+        json.dump(cache, raw)
+
+
+# Anything the result parser wants is far shorter than this; longer is
+# progress output or similar noise.
+_MAX_LINE = 1 << 20
+
+
+async def _iter_lines(stream):
+    """Iterate the lines of the stream, tolerating arbitrarily long ones.
+
+    Iterating the StreamReader directly uses readline, which raises once a
+    line exceeds the reader's limit (64 KiB by default) - pack progress
+    output can easily do that. Chunked reads with a manual split cope with
+    anything, discarding pathologically long lines.
+    """
+    buffer = bytearray()
+    while True:
+        chunk = await stream.read(1 << 16)
+        if not chunk:
+            if buffer:
+                yield bytes(buffer)
+            return
+        buffer += chunk
+        *lines, rest = buffer.split(b"\n")
+        for line in lines:
+            yield line
+        del buffer[:]
+        if len(rest) <= _MAX_LINE:
+            buffer += rest
+
+
+async def _parse_analyse_output(
+    stderr,
+    repo: pathlib.Path,
+    results: collections.Counter,
+    by_repo: collections.Counter,
+):
+    """Parse analyse result lines from the stream as they arrive.
+
+    Returns the parsed (key, result) pairs and the problem count, so the
+    caller can cache them. Parsing as the output streams means memory use is
+    constant, rather than proportional to the size of charmcraft's output.
+    """
+    parsed = []
+    problems = 0
+    async for raw in _iter_lines(stderr):
+        line = raw.decode().strip()
+        if line.startswith(_CONT_PREFIXES):
+            continue
+        mo = _ANALYSE_RE.match(line)
+        if not mo:
+            continue
+        parsed.append((mo.group("key"), mo.group("result")))
+        results[mo.group("key"), mo.group("result")] += 1
+        if mo.group("result").lower() == "ok":
+            continue
+        if line.startswith(_SKIP_PREFIXES):
+            continue
+        problems += 1
+        by_repo[repo.name] += 1
+    return parsed, problems
+
+
+async def analyse_charm(
+    repo: pathlib.Path,
+    charm_name: str,
+    results: collections.Counter,
+    by_repo: collections.Counter,
+):
+    """Run `charmcraft analyse` on a packed charm and collect the results.
+
+    Returns the parsed (key, result) pairs and the problem count, so the
+    caller can cache them, or None if the analyse failed.
+    """
+    logger.info("Analysing %s in %s", charm_name, repo)
+    analyse = await asyncio.create_subprocess_exec(
+        "charmcraft",
+        "analyse",
+        charm_name,
+        cwd=repo,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    parsed, problems = await _parse_analyse_output(
+        analyse.stderr, repo, results, by_repo
+    )
+    await analyse.wait()
+    if analyse.returncode != 0:
+        logger.warning("`charmcraft analyse` failed for %s", repo)
+        return None
+    return parsed, problems
+
+
+async def analyse_repo(
+    sem: asyncio.Semaphore,
+    repo: pathlib.Path,
+    repack: bool,
+    results: collections.Counter,
+    by_repo: collections.Counter,
+):
+    """Pack the charm if required, then analyse each packed charm."""
+    async with sem:
+        charms = sorted(repo.glob("*.charm"))
+        # Packing takes tens of seconds per charm, so skip it when the
+        # existing artefact is newer than all of the charm's sources.
+        src_mtime = max(
+            (p.stat().st_mtime_ns for p in repo.rglob("src/**/*.py")), default=0
+        )
+        stale = any(c.stat().st_mtime_ns < src_mtime for c in charms)
+        if repack or stale or not charms:
+            # One shell invocation chains the pack, analyse, and clean -
+            # one fork/exec (and one charmcraft/LXD warm-up) instead of three.
+            command = "charmcraft pack && charmcraft analyse *.charm"
+            if repack:
+                # Don't leave a build container/cache behind for every charm.
+                command += " && charmcraft clean"
+            logger.info("Packing and analysing %s", repo)
+            chained = await asyncio.create_subprocess_shell(
+                command,
+                cwd=repo,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            parsed, problems = await _parse_analyse_output(
+                chained.stderr, repo, results, by_repo
+            )
+            await chained.wait()
+            if chained.returncode != 0:
+                logger.warning("`%s` failed for %s", command, repo)
+                return
+            charms = sorted(repo.glob("*.charm"))
+            if len(charms) == 1:
+                # With a single charm, all of the output belongs to it, so
+                # the results can be cached against the artefact.
+                cache = _load_analyse_cache(repo)
+                cache[charms[0].name] = {
+                    "digest": hashlib.sha256(charms[0].read_bytes()).hexdigest(),
+                    "results": parsed,
+                    "problems": problems,
+                }
+                _store_analyse_cache(repo, cache)
+            return
+        # Analyse results only change when the packed charm does, so replay
+        # cached results for unchanged artefacts rather than re-analysing.
+        cache = _load_analyse_cache(repo)
+        dirty = False
+        for charm in charms:
+            digest = hashlib.sha256(charm.read_bytes()).hexdigest()
+            cached = cache.get(charm.name)
+            if cached and cached["digest"] == digest:
+                logger.info("Using cached analyse results for %s", charm)
+                for key, result in cached["results"]:
+                    results[key, result] += 1
+                if cached["problems"]:
+                    by_repo[repo.name] += cached["problems"]
+                continue
+            analysed = await analyse_charm(repo, charm.name, results, by_repo)
+            if analysed is not None:
+                parsed, problems = analysed
+                cache[charm.name] = {
+                    "digest": digest,
+                    "results": parsed,
+                    "problems": problems,
+                }
+                dirty = True
+        if dirty:
+            _store_analyse_cache(repo, cache)
+
+
+async def process_repositories(
+    cache_folder: pathlib.Path,
+    repack: bool,
+    parallel: int,
+    results: collections.Counter,
+    by_repo: collections.Counter,
+):
+    """Pack and analyse all of the repositories, boundedly concurrently."""
+    # Packing is CPU (and LXD) heavy, so keep the bound low by default.
+    sem = asyncio.Semaphore(parallel)
+    total = 0
+    async with asyncio.TaskGroup() as tg:
+        for repo in iter_repositories(cache_folder):
+            total += 1
+            tg.create_task(analyse_repo(sem, repo, repack, results, by_repo))
+    return total
+
+
+@click.option("--cache-folder", default=".cache")
+@click.option("--repack/--no-repack", default=False)
+@click.option("--parallel", default=4, type=click.IntRange(1))
+@click.command()
+def main(cache_folder: str, repack: bool, parallel: int):
+    """Output simple statistics about `charmcraft analyse` results.
+
+    Requires `charmcraft` to be installed and able to pack the charms (which
+    can take a long time on the first run).
+    """
+    configure_logging()
+
+    results = collections.Counter()
+    by_repo = collections.Counter()
+    total = asyncio.run(
+        process_repositories(
+            pathlib.Path(cache_folder), repack, parallel, results, by_repo
+        )
+    )
+
+    report(total, results, by_repo)
+
+
+def report(total, results, by_repo):
+    """Output a report of the results to the console."""
+    import rich.console
+
+    console = rich.console.Console()
+    console.print()  # Separate out from any logging.
+
+    table = count_and_percentage_table(
+        "Analyse Results",
+        "Check",
+        total,
+        sorted((f"{key}: {result}", count) for (key, result), count in results.items()),
+    )
+    console.print(table)
+    console.print()
+
+    table = count_and_percentage_table(
+        "Problems per Repository", "Repository", total, by_repo.most_common(20)
+    )
+    console.print(table)
+    console.print()
+
+    # TODO:
+    # * Break the problems down by lint vs attribute.
+
+
+if __name__ == "__main__":
+    main()
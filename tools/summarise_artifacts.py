@@ -2,69 +2,170 @@
 
 """Summarise information about the charm artifacts on CharmHub"""
 
+import asyncio
 import collections
 import datetime
+import json
 import logging
+import os
 import pathlib
+import re
+import time
 
 import click
 import httpx
-import rich.logging
-import yaml
+from helpers import configure_logging
 from helpers import count_and_percentage_table
 from helpers import iter_repositories
 
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None  # type: ignore
+
 logger = logging.getLogger(__name__)
 
+# How long a cached CharmHub response is served without even a conditional
+# request. The store data changes slowly, so a day is plenty fresh.
+_CACHE_TTL = 24 * 60 * 60
 
-def charm_details(name):
-    """Collect information about a charm from CharmHub."""
+# The top-level "name" field of a metadata.yaml/charmcraft.yaml. Matching
+# this directly avoids parsing (and building Python objects for) the whole
+# document when the name is the only field that's wanted.
+_NAME_RE = re.compile(rb"^name:\s*[\"']?([A-Za-z0-9._-]+)", re.M)
+
+
+def _charm_name(path: pathlib.Path):
+    """Extract the top-level name field, or None if there isn't one."""
+    mo = _NAME_RE.search(path.read_bytes())
+    return mo.group(1).decode() if mo else None
+
+
+def _json_loads(raw: bytes):
+    """Decode JSON with orjson (C, much faster) when it's available."""
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+
+def _load_http_cache(path: pathlib.Path):
+    """Load a previously stored CharmHub response, or None."""
+    try:
+        return _json_loads(path.read_bytes())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _store_http_cache(path: pathlib.Path, etag: str, data: dict):
+    """Atomically store a CharmHub response against its ETag."""
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("w") as raw:
+        json.dump({"etag": etag, "data": data}, raw)
+    os.replace(tmp, path)
+
+
+async def _get_charm_info(
+    client: httpx.AsyncClient,
+    sem: asyncio.Semaphore,
+    name: str,
+    cache_dir: pathlib.Path,
+):
+    """Fetch the CharmHub info for a charm, with a persistent on-disk cache.
+
+    Recently fetched responses are served straight from disk; older ones are
+    revalidated with a conditional request, so an unchanged response costs a
+    304 rather than a re-download and re-parse.
+    """
     # TODO: Figure out what other fields might be interesting.
     url = f"http://api.snapcraft.io/v2/charms/info/{name}?fields=channel-map,result.store-url"
-    data = httpx.get(url).raise_for_status().json()
+    cache_path = cache_dir / f"{name}.json"
+    cached = _load_http_cache(cache_path)
+    if cached is not None and time.time() - cache_path.stat().st_mtime < _CACHE_TTL:
+        return cached["data"]
+    headers = {}
+    if cached is not None and cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    async with sem:
+        response = await client.get(url, headers=headers)
+    if response.status_code == 304 and cached is not None:
+        # Refresh the TTL - the store confirmed the response is unchanged.
+        cache_path.touch()
+        return cached["data"]
+    # Decode from the raw bytes rather than response.json(): for large
+    # channel maps the stdlib decode dominates once the network is overlapped.
+    data = _json_loads(response.raise_for_status().content)
+    _store_http_cache(cache_path, response.headers.get("etag", ""), data)
+    return data
+
+
+async def charm_details(
+    client: httpx.AsyncClient,
+    sem: asyncio.Semaphore,
+    name: str,
+    cache_dir: pathlib.Path,
+    now: datetime.datetime,
+):
+    """Collect information about a charm from CharmHub."""
+    data = await _get_charm_info(client, sem, name, cache_dir)
     store_url = data["result"]["store-url"]
     logger.info("The store URL for %s is %s", name, store_url)
-    # Channel also has "base" and "name".
-    # TODO: There's no need to loop through the objs many times like this - just
-    # do one loop that builds up all the different lists (which can just be sets).
-    tracks = [obj["channel"]["track"] for obj in data["channel-map"]]
-    channels = [obj["channel"]["risk"] for obj in data["channel-map"]]
-    release_times = [
-        datetime.datetime.fromisoformat(obj["channel"]["released-at"])
-        for obj in data["channel-map"]
-    ]
-    # Revision also has "version" (what is the difference with 'revision'?),
-    # created-at, download, and bases.
-    revisions = [obj["revision"]["revision"] for obj in data["channel-map"]]
-    attributes = [obj["revision"]["attributes"] for obj in data["channel-map"]]
+    # One pass over the channel map, building only what the caller consumes.
+    # Each channel also has "base", "name", "track", and "risk", and each
+    # revision also has "revision", "version", "created-at", "download", and
+    # "bases", if those become interesting later.
     # TODO: check if there are attributes other than framework and language.
+    frameworks = set()
+    languages = set()
+    newest = oldest = None
+    for obj in data["channel-map"]:
+        attributes = obj["revision"]["attributes"]
+        framework = attributes.get("framework", "unknown")
+        if framework != "unknown":
+            frameworks.add(framework)
+        language = attributes.get("language", "unknown")
+        if language != "unknown":
+            languages.add(language)
+        released_at = obj["channel"]["released-at"]
+        if newest is None or released_at > newest:
+            newest = released_at
+        if oldest is None or released_at < oldest:
+            oldest = released_at
+    # The store's ISO-8601 timestamps share one format, so they sort
+    # lexicographically: only the newest and the oldest need actually
+    # parsing into datetime objects.
+    from_iso = datetime.datetime.fromisoformat
+    min_age = (now - from_iso(newest)).days
+    max_age = (now - from_iso(oldest)).days
+    return frameworks, languages, min_age, max_age
+
+
+async def gather_details(names: list[str], cache_folder: pathlib.Path):
+    """Fetch the details of all the charms concurrently.
 
-    frameworks = {
-        attribute["framework"]
-        for attribute in attributes
-        if "framework" in attribute and attribute["framework"] != "unknown"
-    }
-    languages = {
-        attribute["language"]
-        for attribute in attributes
-        if "language" in attribute and attribute["language"] != "unknown"
-    }
+    The work is network-bound, so overlapping the requests (bounded, as in
+    get_charms.py) collapses the wall time towards a single round-trip.
+    """
+    cache_dir = cache_folder / ".snapcraft"
+    cache_dir.mkdir(exist_ok=True)
+    sem = asyncio.Semaphore(32)
+    # All the ages are relative to the same moment - one clock read for the
+    # whole run, rather than one per charm.
     now = datetime.datetime.now(datetime.timezone.utc)
-    ages = {(now - release_time).days for release_time in release_times}
-    return frameworks, languages, set(tracks), set(channels), set(revisions), ages
+    async with httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        timeout=30,
+        headers={"User-Agent": "charm-analysis"},
+    ) as client:
+        return await asyncio.gather(
+            *(charm_details(client, sem, name, cache_dir, now) for name in names),
+            return_exceptions=True,
+        )
 
 
 @click.option("--cache-folder", default=".cache")
 @click.command()
 def main(cache_folder):
     """Output simple statistics about the charm artifacts."""
-    FORMAT = "%(message)s"
-    logging.basicConfig(
-        level=logging.INFO,
-        format=FORMAT,
-        datefmt="[%X]",
-        handlers=[rich.logging.RichHandler()],
-    )
+    configure_logging()
 
     total = 0
     all_frameworks = collections.Counter()
@@ -76,28 +177,33 @@ def main(cache_folder):
     max_ages = collections.Counter()
     # TODO: figure out what to do with bundles - should I iterate through
     # those instead?
-    for entry in iter_repositories(pathlib.Path(cache_folder)):
+    cache_folder = pathlib.Path(cache_folder)
+    entries = []
+    names = []
+    for entry in iter_repositories(cache_folder):
         metadata = entry / "metadata.yaml"
         charmcraft = entry / "charmcraft.yaml"
         if metadata.exists():
-            with metadata.open() as raw:
-                name = yaml.safe_load(raw)["name"]
+            name = _charm_name(metadata)
         elif charmcraft.exists():
-            with charmcraft.open() as raw:
-                try:
-                    name = yaml.safe_load(raw)["name"]
-                except KeyError:
-                    logger.warning("charmcraft.yaml with no name: %s", entry)
-                    continue
+            name = _charm_name(charmcraft)
+            if name is None:
+                logger.warning("charmcraft.yaml with no name: %s", entry)
+                continue
         else:
+            name = None
+        if name is None:
             logger.warning("Cannot find name for %s", entry)
             continue
-        # TODO: This could be async, since it's doing a bunch of network requests.
-        try:
-            frameworks, languages, tracks, channels, revisions, ages = charm_details(name)
-        except httpx.HTTPStatusError as e:
-            logger.warning("Unable to get store info for %s: %s", entry, e)
+        entries.append(entry)
+        names.append(name)
+
+    details = asyncio.run(gather_details(names, cache_folder))
+    for entry, detail in zip(entries, details):
+        if isinstance(detail, Exception):
+            logger.warning("Unable to get store info for %s: %s", entry, detail)
             continue
+        frameworks, languages, min_age, max_age = detail
         total += 1
         if len(frameworks) > 1:
             logger.warning("%s uses multiple frameworks: %s", entry, frameworks)
@@ -108,14 +214,16 @@ def main(cache_folder):
         for language in languages:
             all_languages[language] += 1
         # TODO: Is there more that would be interesting than just max/min?
-        min_ages[min(ages)] += 1
-        max_ages[max(ages)] += 1
+        min_ages[min_age] += 1
+        max_ages[max_age] += 1
 
     report(total, all_frameworks, all_languages, min_ages, max_ages)
 
 
 def report(total, frameworks, languages, min_ages, max_ages):
     """Output a report of the results to the console."""
+    import rich.console
+
     console = rich.console.Console()
     console.print()  # Separate out from any logging.
 
@@ -125,16 +233,22 @@ def report(total, frameworks, languages, min_ages, max_ages):
     console.print(table)
     console.print()
 
-    table = count_and_percentage_table("Languages", "Language", total, sorted(languages.items()))
+    table = count_and_percentage_table(
+        "Languages", "Language", total, sorted(languages.items())
+    )
     console.print(table)
     console.print()
 
     # TODO: probably this and the next one should be bucketed?
-    table = count_and_percentage_table("Newest Artifact", "Days", total, sorted(min_ages.items()))
+    table = count_and_percentage_table(
+        "Newest Artifact", "Days", total, sorted(min_ages.items())
+    )
     console.print(table)
     console.print()
 
-    table = count_and_percentage_table("Oldest Artifact", "Days", total, sorted(max_ages.items()))
+    table = count_and_percentage_table(
+        "Oldest Artifact", "Days", total, sorted(max_ages.items())
+    )
     console.print(table)
     console.print()
 
@@ -4,96 +4,206 @@
 
 import ast
 import collections
+import concurrent.futures
 import csv
+import functools
+import hashlib
+import itertools
+import json
 import logging
+import os
 import pathlib
+import re
+import struct
 
 import click
-import rich.logging
+from helpers import configure_logging
 from helpers import count_and_percentage_table
 from helpers import iter_entries
 
 logger = logging.getLogger(__name__)
 
 
+# Rough but should be sufficient.
+_EVENT_RE = re.compile(r"_(pebble_ready|action|relation_\w+)$")
+
+
+@functools.lru_cache(maxsize=1024)
 def _normalise_event(event: str):
-    """Drop uninteresting elements like the names of containers."""
-    if event.endswith("_pebble_ready"):
-        return "pebble_ready"
-    elif event.endswith("_action"):
-        return "action"
-    # Rough but should be sufficient.
-    elif "_relation_" in event:
-        return "_".join(event.rsplit("_", 2)[1:])
-    return event
-
-
-def observing(module: pathlib.Path):
-    """Iterate through the events that a charm is observing."""
-    with module.open() as charm:
-        tree = ast.parse(charm.read())
-    # Assume that any calls to a method called "observe" are framework.observe calls.
-    for node in ast.walk(tree):
-        if (
-            not isinstance(node, ast.Call)
-            or not isinstance(node.func, ast.Attribute)
-            or node.func.attr != "observe"
-            or not node.args
-        ):
-            continue
-        arg0 = node.args[0]
-        if isinstance(arg0, ast.Attribute):
-            yield _normalise_event(arg0.attr), node.args[1].attr
-        elif isinstance(arg0, ast.Name):
-            yield _normalise_event(arg0.id), node.args[1].attr
-        elif (
-            isinstance(arg0, ast.Call)
-            and getattr(arg0.func, "id", "") == "getattr"
-            and arg0.args[0].attr == "on"
-        ):
-            yield _normalise_event(arg0.args[1].value), node.args[1].attr
-        else:
-            yield "TODO", "TODO"
-
-
-def defer_count(module: pathlib.Path):
-    """Count the number of times that defer() is called."""
-    count = 0
-    with module.open() as charm:
-        tree = ast.parse(charm.read())
-    # Assume that all calls to a function called "defer" are event.defer()s.
-    for node in ast.walk(tree):
-        if (
-            not isinstance(node, ast.Call)
-            or not isinstance(node.func, ast.Attribute)
-            or node.func.attr != "defer"
-        ):
-            continue
-        count += 1
-    return count
-
-
-def relation_broken(module: pathlib.Path, handler_name: str):
-    with module.open() as charm:
-        logger.info("%s has a relation-broken event handler, %s", module, handler_name)
-        tree = ast.parse(charm.read())
-        # Walk through the tree to get to the methods we want - there are much better ways
-        # to do this.
-        for node in ast.walk(tree):
-            if isinstance(node, ast.FunctionDef) and node.name == handler_name:
-                body = node.body
-                break
+    """Drop uninteresting elements like the names of containers.
+
+    This runs once per observe() call site across thousands of charms, so
+    one compiled (C-level) match replaces the chain of endswith/in/rsplit
+    string operations, and event names repeat massively, so the results are
+    memoised too.
+    """
+    mo = _EVENT_RE.search(event)
+    return mo.group(1) if mo else event
+
+
+class CharmAnalyzer(ast.NodeVisitor):
+    """Collect everything the summaries need in a single AST descent.
+
+    Observed events, defer() calls, and function definitions used to each be
+    found with an independent ast.walk over the same tree; one visitor pass
+    amortises the traversal and the isinstance checks.
+    """
+
+    def __init__(self):
+        self.events = []  # (normalised event, handler method name) pairs.
+        self.defers = 0
+        self.functions = {}  # Function name -> FunctionDef node.
+
+    def _skip(self, node: ast.AST):
+        """No observe()/defer() calls can hide under these, so don't descend.
+
+        Names and constants are the bulk of a module's nodes, and imports
+        and argument lists can't contain the calls of interest; a no-op
+        handler saves the generic_visit dispatch over their children.
+        """
+
+    visit_Name = visit_Constant = visit_Import = visit_ImportFrom = _skip
+    visit_arguments = _skip
+
+    def visit_FunctionDef(self, node: ast.FunctionDef):
+        self.functions[node.name] = node
+        self.generic_visit(node)
+
+    def visit_Call(self, node: ast.Call):
+        func = node.func
+        if isinstance(func, ast.Attribute):
+            # Assume that all calls to a function called "defer" are
+            # event.defer()s, and that any calls to a method called "observe"
+            # are framework.observe calls.
+            if func.attr == "defer":
+                self.defers += 1
+            elif func.attr == "observe" and node.args:
+                arg0 = node.args[0]
+                if isinstance(arg0, ast.Attribute):
+                    self.events.append((_normalise_event(arg0.attr), node.args[1].attr))
+                elif isinstance(arg0, ast.Name):
+                    self.events.append((_normalise_event(arg0.id), node.args[1].attr))
+                elif (
+                    isinstance(arg0, ast.Call)
+                    and getattr(arg0.func, "id", "") == "getattr"
+                    and arg0.args[0].attr == "on"
+                ):
+                    self.events.append((
+                        _normalise_event(arg0.args[1].value),
+                        node.args[1].attr,
+                    ))
+                else:
+                    self.events.append(("TODO", "TODO"))
+        self.generic_visit(node)
+
+
+def _analyse_module(path: str):
+    """Run the visitor over a module and reduce it to plain JSON-able facts."""
+    analyzer = CharmAnalyzer()
+    # Feed ast.parse the raw bytes: a text-mode read would decode the file
+    # only for the parser to work out the encoding again itself.
+    with open(path, "rb") as charm:
+        analyzer.visit(ast.parse(charm.read(), filename=path))
+    facts = {"events": analyzer.events, "defers": analyzer.defers}
+    handler = next(
+        (method for event, method in analyzer.events if event == "relation_broken"),
+        None,
+    )
+    if handler is not None:
+        node = analyzer.functions.get(handler)
+        if node is None:
+            facts["relation_broken"] = {"handler": handler, "found": False}
         else:
-            logger.info("Couldn't find %s in %s", handler_name, module)
-            return
-        for expr in body:
-            for node in ast.walk(expr):
-                # Is this sufficient to check what we need to know?
-                if isinstance(node, ast.Attribute):
-                    if node.attr == "id":
-                        logger.info("Found x.id in relation-broken handler.")
-                    elif node.attr == "relation":
-                        logger.info("Found .relation in relation-broken handler.")
+            # Is this sufficient to check what we need to know?
+            attrs = {
+                sub.attr
+                for expr in node.body
+                for sub in ast.walk(expr)
+                if isinstance(sub, ast.Attribute)
+            }
+            facts["relation_broken"] = {
+                "handler": handler,
+                "found": True,
+                "id": "id" in attrs,
+                "relation": "relation" in attrs,
+            }
+    return facts
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_analyse(path: str, mtime_ns: int, cache_dir: str | None):
+    if cache_dir is None:
+        return _analyse_module(path)
+    # Across invocations the same (unchanged) modules are re-analysed every
+    # run, so persist the extracted facts too, keyed on path and mtime (a
+    # keyed blake2b digest is cheaper than hashing the file contents).
+    digest = hashlib.blake2b(
+        path.encode() + struct.pack("<q", mtime_ns), digest_size=16
+    ).hexdigest()
+    cache_path = pathlib.Path(cache_dir, f"{digest}.json")
+    try:
+        return json.loads(cache_path.read_bytes())
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+    facts = _analyse_module(path)
+    tmp = cache_path.with_name(cache_path.name + ".tmp")
+    tmp.write_text(json.dumps(facts))
+    os.replace(tmp, cache_path)
+    return facts
+
+
+def _analyse(module: pathlib.Path, cache_dir: str | None = None):
+    """Parse and analyse a module, caching the result.
+
+    Parsing is the dominant per-module cost, and several of the summaries
+    below want facts about the same module, so memoise by path and mtime (as
+    helpers does for YAML) and parse and walk each module at most once.
+    """
+    return _cached_analyse(str(module), module.stat().st_mtime_ns, cache_dir)
+
+
+def relation_broken(facts: dict, module: pathlib.Path):
+    info = facts["relation_broken"]
+    logger.info("%s has a relation-broken event handler, %s", module, info["handler"])
+    if not info["found"]:
+        logger.info("Couldn't find %s in %s", info["handler"], module)
+        return
+    if info["id"]:
+        logger.info("Found x.id in relation-broken handler.")
+    if info["relation"]:
+        logger.info("Found .relation in relation-broken handler.")
+
+
+def _python_modules(base: pathlib.Path):
+    """All the Python modules under the folder, in a single os.walk descent.
+
+    os.walk reuses scandir's cached dirent types, where a recursive glob
+    pays an extra stat per entry to re-learn what kind it is.
+    """
+    for dirpath, _, filenames in os.walk(base):
+        for name in filenames:
+            if name.endswith(".py"):
+                yield pathlib.Path(dirpath, name)
+
+
+def analyse_entry(entry: pathlib.Path, cache_dir: str | None = None):
+    """Analyse one charm's worth of modules (runs in a worker process).
+
+    Returns the set of observed events, the total defer() count, and the
+    per-module defer() counts, all plain picklable objects.
+    """
+    facts = _analyse(entry, cache_dir)
+    # The handler method names are only needed for the relation-broken
+    # check, and the analysis already recorded that, so build just the set
+    # of event names rather than an intermediate event -> method dict.
+    repo_events = {event for event, _ in facts["events"]}
+    if "relation_broken" in repo_events:
+        relation_broken(facts, entry)
+    per_module = {
+        str(module): _analyse(module, cache_dir)["defers"]
+        for module in _python_modules(entry.parent)
+    }
+    return repo_events, sum(per_module.values()), per_module
 
 
 @click.option("--cache-folder", default=".cache")
@@ -102,13 +212,7 @@ def relation_broken(module: pathlib.Path, handler_name: str):
 @click.command()
 def main(cache_folder, log_defer_over, team_info):
     """Output simple statistics about the charm code."""
-    FORMAT = "%(message)s"
-    logging.basicConfig(
-        level=logging.INFO,
-        format=FORMAT,
-        datefmt="[%X]",
-        handlers=[rich.logging.RichHandler()],
-    )
+    configure_logging()
 
     # TODO: This won't work with bundles or monorepos.
     teams = {}
@@ -120,35 +224,46 @@ def main(cache_folder, log_defer_over, team_info):
             repo = row["Repository"].rsplit("/", 1)[1]
             teams[repo] = row["Team"]
 
-    total = 0
     events = collections.Counter()
     defers = collections.Counter()
     defers_by_team = collections.Counter()
-    for entry in iter_entries(pathlib.Path(cache_folder)):
-        total += 1
-        # This will have some collisions - e.g. all actions get normalised to a
-        # single `event`, relation events are normalised, etc.
-        repo_events = {event: method for event, method in observing(entry)}
-        events.update(repo_events.keys())
-        if "relation_broken" in repo_events:
-            relation_broken(entry, repo_events["relation_broken"])
-        total_defers = sum(defer_count(module) for module in entry.parent.glob("**/*.py"))
-        # TODO: This assumes the entry is in a "src" (or otherwise named) folder.
-        defers_by_team[teams.get(entry.parent.parent.name, "Unknown")] += total_defers
-
-        if total_defers > log_defer_over:
-            logger.info("%s has %s defer() calls", entry, total_defers)
-            for module in entry.parent.glob("**/*.py"):
-                module_count = defer_count(module)
-                if module_count:
-                    logger.info("%s: %s defer() calls", module, module_count)
-        defers[total_defers] += 1
+    entries = list(iter_entries(pathlib.Path(cache_folder)))
+    total = len(entries)
+    ast_cache = pathlib.Path(cache_folder) / ".astcache"
+    ast_cache.mkdir(parents=True, exist_ok=True)
+    # The per-entry analysis is pure CPU (parsing and walking ASTs) with no
+    # shared state, so fan it out across cores and merge the counters here.
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        results = executor.map(
+            analyse_entry, entries, itertools.repeat(str(ast_cache)), chunksize=8
+        )
+        for entry, (repo_events, total_defers, per_module) in zip(entries, results):
+            # This will have some collisions - e.g. all actions get normalised
+            # to a single `event`, relation events are normalised, etc.
+            # Bump the counts directly: Counter.update's dispatch (iterable
+            # vs mapping, self-or-not) costs more than the few increments in
+            # a typical charm's event set, and this runs once per repo.
+            for event in repo_events:
+                events[event] += 1
+            # TODO: This assumes the entry is in a "src" (or otherwise named) folder.
+            defers_by_team[teams.get(entry.parent.parent.name, "Unknown")] += (
+                total_defers
+            )
+
+            if total_defers > log_defer_over:
+                logger.info("%s has %s defer() calls", entry, total_defers)
+                for module, module_count in per_module.items():
+                    if module_count:
+                        logger.info("%s: %s defer() calls", module, module_count)
+            defers[total_defers] += 1
 
     report(total, events, defers, defers_by_team)
 
 
 def report(total, events, defers, defers_by_team):
     """Output a report of the results to the console."""
+    import rich.console
+
     console = rich.console.Console()
     console.print()  # Separate out from any logging.
 
@@ -159,7 +274,9 @@ def report(total, events, defers, defers_by_team):
 
     # Fill in the zeros.
     freq = [(i, defers[i]) for i in range(max(defers) + 1)]
-    table = count_and_percentage_table("event.defer() Frequency", "Frequency", total, freq)
+    table = count_and_percentage_table(
+        "event.defer() Frequency", "Frequency", total, freq
+    )
     table.add_section()
     table.add_row(
         "Total",
@@ -6,18 +6,47 @@ import ast
 import collections
 import logging
 import operator
+import os
 import pathlib
+import re
 import tomllib
 
 import click
 import packaging.requirements
-import rich.console
-import rich.logging
+from helpers import configure_logging
 from helpers import count_and_percentage_table
 from helpers import iter_repositories
 
 logger = logging.getLogger(__name__)
 
+# The distribution name at the start of a requirements line. Names can't
+# start with "-", so option lines (--hash, -r includes, and so on) and
+# blank lines simply fail to match - one anchored scan classifies the line
+# and extracts the name.
+_REQ_NAME_RE = re.compile(r"[A-Za-z0-9._][A-Za-z0-9._-]*")
+
+# Poetry dependency groups that hold development (rather than runtime)
+# dependencies. Compared with spaces stripped, so variants like
+# "static-{charm, lib}" and "static-{charm,lib}" collapse to one entry.
+# Clearly something better is needed here...
+_DEV_SECTIONS = frozenset({
+    "dev",
+    "unit",
+    "integration",
+    "static",
+    "scenario",
+    "static-{charm,lib}",
+    "dev-environment",
+    "static-charm",
+    "static-lib",
+    "charm-integration",
+    "functional",
+    "static-{charm,lib,unit,integration}",
+    "integration-charm",
+    "integration-scaling",
+    "functional-tests",
+})
+
 
 def _ops_version(line: str, location: pathlib.Path):
     """Extract out the version specifier from a requirements line."""
@@ -40,19 +69,27 @@ def requirements_txt(
     all_dependencies_pinned: collections.Counter,
 ):
     with location.open() as requirements:
-        for line in requirements.readlines():
-            line = line.split("#", 1)[0].strip()
-            if not line or line.startswith("--hash"):
-                continue
+        # Iterate the file object directly - readlines() materialises the
+        # whole file as a list first - and partition() beats split() for a
+        # single separator.
+        for line in requirements:
+            line = line.partition("#")[0].strip()
             # Assume that if the line endswith a \ the rest is just hashes and
             # so can be ignored here (is this a reasonable assumption?).
-            line = line.rstrip("\\")
-            if ops_versions and "ops" in line:
+            line = line.rstrip("\\ ")
+            # One anchored match extracts the name; splitting on "=" left
+            # half the comparison operator behind for ">=" pins anyway.
+            mo = _REQ_NAME_RE.match(line)
+            if mo is None:
+                continue
+            name = mo.group()
+            # Compare the extracted name, not a substring - "ops" in line
+            # also matched the likes of opsgenie and python-oops.
+            if ops_versions is not None and name == "ops":
                 ops_versions[_ops_version(line, location)] += 1
             else:
-                # There should be a cleaner way to do this.
-                all_dependencies[line.strip().split("=", 1)[0]] += 1
-                all_dependencies_pinned[line.strip()] += 1
+                all_dependencies[name] += 1
+                all_dependencies_pinned[line] += 1
 
 
 def setup_py(
@@ -63,26 +100,24 @@ def setup_py(
     python_versions: collections.Counter,
 ):
     has_install_requires = False
-    with location.open() as setup:
-        tree = ast.parse(setup.read())
-        for node in ast.walk(tree):
-            if (
-                not isinstance(node, ast.Call)
-                or getattr(node.func, "id", None) != "setup"
-            ):
-                continue
-            for kw in node.keywords:
-                if kw.arg == "install_requires":
-                    has_install_requires = True
-                    for val in kw.value.elts:
-                        if "ops" in val:
-                            ops_versions[_ops_version(val, location)] += 1
-                        else:
-                            # There should be a cleaner way to do this.
-                            all_dependencies[val.split("=", 1)[0]] += 1
-                            all_dependencies_pinned[val] += 1
-                elif kw.arg == "python_requires":
-                    python_versions[kw.value.value] += 1
+    # ast.parse accepts bytes, so skip the text-mode decode - the parser
+    # works out the encoding itself.
+    tree = ast.parse(location.read_bytes(), filename=str(location))
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call) or getattr(node.func, "id", None) != "setup":
+            continue
+        for kw in node.keywords:
+            if kw.arg == "install_requires":
+                has_install_requires = True
+                for val in kw.value.elts:
+                    if "ops" in val:
+                        ops_versions[_ops_version(val, location)] += 1
+                    else:
+                        # There should be a cleaner way to do this.
+                        all_dependencies[val.split("=", 1)[0]] += 1
+                        all_dependencies_pinned[val] += 1
+            elif kw.arg == "python_requires":
+                python_versions[kw.value.value] += 1
     return has_install_requires
 
 
@@ -95,73 +130,52 @@ def pyproject_toml(
     optional_dependency_sections: collections.Counter,
     dev_dependencies=collections.Counter,
 ):
-    with location.open("rb") as pyproject:
-        data = tomllib.load(pyproject)
-        if "dependencies" in data:
-            yield "pyproject.toml"
-            for dep in data["dependencies"]:
-                if "ops" in dep:
-                    ops_versions[_ops_version(dep, location)] += 1
-                else:
-                    # There should be a cleaner way to do this.
-                    all_dependencies[dep.split("=", 1)[0]] += 1
-                    all_dependencies_pinned[dep] += 1
-        if "requires-python" in data:
-            python_versions[data["requires-python"]] += 1
-        for section in data.get("project", {}).get("optional-dependencies", {}):
-            optional_dependency_sections[section] += 1
-            if section == "dev":
-                for dep in data["project"]["optional-dependencies"]["dev"]:
-                    dev_dependencies[dep] += 1
-        if "poetry" in data.get("tool", {}):
-            yield "poetry"
-            for dep in data["tool"]["poetry"].get("dependencies", ()):
-                if dep == "group":
-                    for section in data["tool"]["poetry"]["dependencies"]["group"]:
-                        optional_dependency_sections[section] += 1
-                        # Clearly something better is needed here...
-                        if section in (
-                            "dev",
-                            "unit",
-                            "integration",
-                            "static",
-                            "scenario",
-                            "static-{charm,lib}",
-                            "dev-environment",
-                            "static-charm",
-                            "static-lib",
-                            "charm-integration",
-                            "functional",
-                            "static-{charm,lib,unit,integration}",
-                            "integration-charm",
-                            "integration-scaling",
-                            "functional-tests",
-                            "static-{charm, lib}",
-                        ):
-                            for devdep in data["tool"]["poetry"]["dependencies"][
-                                "group"
-                            ][section].get("dependencies", ()):
-                                dev_dependencies[devdep] += 1
-                    continue
-                if "ops" in dep:
-                    ops_versions[_ops_version(dep, location)] += 1
-                else:
-                    # There should be a cleaner way to do this.
-                    all_dependencies[dep.split("=", 1)[0]] += 1
-                    all_dependencies_pinned[dep] += 1
+    # Parse from the raw bytes rather than through a file object, and bind
+    # the nested tables to locals - re-indexing from the top of the document
+    # for every section and dependency adds up over thousands of repos.
+    data = tomllib.loads(location.read_bytes().decode())
+    if "dependencies" in data:
+        yield "pyproject.toml"
+        for dep in data["dependencies"]:
+            if "ops" in dep:
+                ops_versions[_ops_version(dep, location)] += 1
+            else:
+                # There should be a cleaner way to do this.
+                all_dependencies[dep.split("=", 1)[0]] += 1
+                all_dependencies_pinned[dep] += 1
+    if "requires-python" in data:
+        python_versions[data["requires-python"]] += 1
+    optional = data.get("project", {}).get("optional-dependencies", {})
+    for section, section_deps in optional.items():
+        optional_dependency_sections[section] += 1
+        if section == "dev":
+            for dep in section_deps:
+                dev_dependencies[dep] += 1
+    poetry = data.get("tool", {}).get("poetry")
+    if poetry is not None:
+        yield "poetry"
+        dependencies = poetry.get("dependencies", {})
+        for dep in dependencies:
+            if dep == "group":
+                for section, spec in dependencies["group"].items():
+                    optional_dependency_sections[section] += 1
+                    if section.replace(" ", "") in _DEV_SECTIONS:
+                        for devdep in spec.get("dependencies", ()):
+                            dev_dependencies[devdep] += 1
+                continue
+            if "ops" in dep:
+                ops_versions[_ops_version(dep, location)] += 1
+            else:
+                # There should be a cleaner way to do this.
+                all_dependencies[dep.split("=", 1)[0]] += 1
+                all_dependencies_pinned[dep] += 1
 
 
 @click.option("--cache-folder", default=".cache")
 @click.command()
 def main(cache_folder: str):
     """Output simple statistics about the dependencies of the charms."""
-    FORMAT = "%(message)s"
-    logging.basicConfig(
-        level=logging.INFO,
-        format=FORMAT,
-        datefmt="[%X]",
-        handlers=[rich.logging.RichHandler()],
-    )
+    configure_logging()
 
     total = 0
     dependencies_source = collections.Counter()
@@ -177,7 +191,14 @@ def main(cache_folder: str):
         # It's possible that a single repository has more than one of these.
         # For now, let's count them all, although we'll need to de-duplicate the
         # Python and ops version counts.
-        if (repo / "requirements.txt").exists():
+        # One scandir (a single readdir) answers all four probes, rather
+        # than a stat syscall per candidate file.
+        try:
+            with os.scandir(repo) as entries:
+                files = {e.name for e in entries if e.is_file(follow_symlinks=False)}
+        except FileNotFoundError:
+            files = set()
+        if "requirements.txt" in files:
             dependencies_source["requirements.txt"] += 1
             requirements_txt(
                 repo / "requirements.txt",
@@ -185,7 +206,7 @@ def main(cache_folder: str):
                 all_dependencies,
                 all_dependencies_pinned,
             )
-        if (repo / "requirements-dev.txt").exists():
+        if "requirements-dev.txt" in files:
             dependencies_source["requirements-dev.txt"] += 1
             requirements_txt(
                 repo / "requirements-dev.txt",
@@ -193,7 +214,7 @@ def main(cache_folder: str):
                 all_dependencies,
                 all_dependencies_pinned,
             )
-        if (repo / "setup.py").exists():
+        if "setup.py" in files:
             if setup_py(
                 repo / "setup.py",
                 ops_versions,
@@ -202,7 +223,7 @@ def main(cache_folder: str):
                 python_versions,
             ):
                 dependencies_source["setup.py"] += 1
-        if (repo / "pyproject.toml").exists():
+        if "pyproject.toml" in files:
             for source in pyproject_toml(
                 repo / "pyproject.toml",
                 ops_versions,
@@ -234,6 +255,8 @@ def report(
     optional_dependency_sections,
 ):
     """Output a report of the results to the console."""
+    import rich.console
+
     console = rich.console.Console()
     console.print()  # Separate out from any logging.
 
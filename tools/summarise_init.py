@@ -3,19 +3,28 @@
 """Summarise what charms do in __init__ (directly or indirectly)."""
 
 import ast
+import builtins
 import collections
-import copy
+import concurrent.futures
+import hashlib
+import itertools
 import logging
-import operator
+import os
 import pathlib
+import pickle
 
 import click
-import rich.logging
+from helpers import configure_logging
 from helpers import count_and_percentage_table
 from helpers import iter_entries
 
 logger = logging.getLogger(__name__)
 
+# visit_Call consults these once per call node, so build them once: a
+# frozenset lookup rather than dir() re-listing the builtins every time.
+_BUILTIN_NAMES = frozenset(dir(builtins))
+_NO_RECURSE_NAMES = frozenset({"logger", "tempfile"})
+
 
 def _get_root_tree(path):
     with path.open() as file:
@@ -23,7 +32,10 @@ def _get_root_tree(path):
 
 
 def _find_charm_ast(tree):
-    for node in ast.walk(tree):
+    # Charm classes are defined at module level, so look only at the
+    # top-level statements - ast.walk would descend through every function
+    # body in the module as well.
+    for node in tree.body:
         if isinstance(node, ast.ClassDef):
             for base in node.bases:
                 if isinstance(base, ast.Name) and base.id == "CharmBase":
@@ -34,17 +46,21 @@ def _find_charm_ast(tree):
     return None
 
 
-def _find_func_by_name(tree, name):
-    logger.debug("Searching for %s in %s", name, tree)
-    for node in ast.walk(tree):
-        if isinstance(node, ast.FunctionDef) and node.name == name:
-            return node
-    return None
+def _index_funcs(body):
+    """Index the function definitions directly inside a module or class body.
+
+    Looking functions up by name used to re-walk the whole module per call
+    site, which made the counting quadratic in the size of the charm.
+    """
+    return {node.name: node for node in body if isinstance(node, ast.FunctionDef)}
 
 
 class OperationCounter(ast.NodeVisitor):
-    def __init__(self, tree: ast.AST):
-        self.tree = tree
+    def __init__(self, module_funcs: dict, charm_methods: dict):
+        self.module_funcs = module_funcs
+        self.charm_methods = charm_methods
+        # Guards against revisiting a function (and recursion cycles).
+        self._visited = set()
         self.calls = collections.Counter()
         self.constants = collections.Counter()
         self.names = collections.Counter()
@@ -53,30 +69,34 @@ class OperationCounter(ast.NodeVisitor):
         self.explicit_return = collections.Counter()
 
     def visit_Call(self, node: ast.Call):
-        node = copy.deepcopy(node)
-        node.args.clear()
-        node.keywords.clear()
-        self.calls[ast.unparse(node)] += 1
+        # Unparsing just the func subtree gives the same "name()" key that
+        # deep-copying the call and blanking its arguments used to produce,
+        # without copying (or unparsing) the argument subtrees at all.
+        self.calls[ast.unparse(node.func) + "()"] += 1
 
         # Recurse into the call, simplistically.
         # TODO: It seems like this could be made to recurse into libs,
         # especially when it's instantiating a lib class (so the __init__ of
         # that class).
         if isinstance(node.func, ast.Name):
-            if node.func.id in dir(__builtins__):
+            if node.func.id in _BUILTIN_NAMES:
                 logger.debug("No recursing into builtin %s", node.func.id)
             elif node.func.id == "observe":
                 logger.debug("Not trying to recurse into ops.")
             else:
-                sub = _find_func_by_name(self.tree, node.func.id)
-                if sub:
-                    logger.info("Recursing into global %s", node.func.id)
-                    self.visit(sub)
-                else:
+                sub = self.module_funcs.get(node.func.id)
+                if sub is not None:
+                    if id(sub) not in self._visited:
+                        self._visited.add(id(sub))
+                        logger.info("Recursing into global %s", node.func.id)
+                        self.visit(sub)
+                elif logger.isEnabledFor(logging.INFO):
+                    # Unparsing just for the message is wasted work when
+                    # INFO is off, so gate it.
                     logger.info("Could not find function %s", ast.unparse(node.func))
         elif isinstance(node.func, ast.Attribute):
             if isinstance(node.func.value, ast.Name):
-                if node.func.value.id in ("logger", "tempfile"):
+                if node.func.value.id in _NO_RECURSE_NAMES:
                     logger.debug(
                         "Not trying to recurse into stdlib %s", node.func.value.id
                     )
@@ -86,12 +106,13 @@ class OperationCounter(ast.NodeVisitor):
                     # An assumption, but seems reasonable.
                     logger.debug("Not trying to recurse into list append.")
                 else:
-                    charm = _find_charm_ast(self.tree)
-                    sub = _find_func_by_name(charm, node.func.attr)
-                    if sub:
-                        logger.info("Recursing into method %s", node.func.attr)
-                        self.visit(sub)
-                    else:
+                    sub = self.charm_methods.get(node.func.attr)
+                    if sub is not None:
+                        if id(sub) not in self._visited:
+                            self._visited.add(id(sub))
+                            logger.info("Recursing into method %s", node.func.attr)
+                            self.visit(sub)
+                    elif logger.isEnabledFor(logging.INFO):
                         logger.info("Could not find method %s", ast.unparse(node.func))
             else:
                 logger.warning("Unknown attribute value type: %s", node.func.value)
@@ -139,23 +160,50 @@ class OperationCounter(ast.NodeVisitor):
         self.explicit_return[node.value] += 1
 
 
-def walk_init(path):
+def walk_init(path, cache_dir=None):
     """Walk through the __init__ method and summarise what it does.
 
     Using the ast module, walk through the __init__ method and get counts for
     each of the operations that it executes, recursively walking through any
     function that's called.
+
+    The counters only change when the module does, so when a cache folder is
+    given, pickle them there keyed on path and mtime - warm runs skip the
+    parse and walk entirely.
     """
+    if cache_dir is not None:
+        key = hashlib.blake2b(
+            f"{path}:{path.stat().st_mtime_ns}".encode(), digest_size=16
+        ).hexdigest()
+        cache_path = pathlib.Path(cache_dir, f"{key}.pkl")
+        try:
+            return pickle.loads(cache_path.read_bytes())
+        except (FileNotFoundError, pickle.UnpicklingError, EOFError):
+            pass
+    counter = _walk_init(path)
+    if cache_dir is not None:
+        tmp = cache_path.with_name(cache_path.name + ".tmp")
+        tmp.write_bytes(pickle.dumps(counter))
+        os.replace(tmp, cache_path)
+    return counter
+
+
+def _walk_init(path):
     tree = _get_root_tree(path)
     charm = _find_charm_ast(tree)
     if not charm:
         logger.warning("Could not find a CharmBase subclass in %s", path)
         return
-    init = _find_func_by_name(charm, "__init__")
+    module_funcs = _index_funcs(tree.body)
+    charm_methods = _index_funcs(charm.body)
+    init = charm_methods.get("__init__")
     if not init:
         logger.warning("Could not find __init__ in %s, %s", path, charm)
-    counter = OperationCounter(charm)
+    counter = OperationCounter(module_funcs, charm_methods)
     counter.visit(init)
+    # The function indexes reference the whole AST, which is enormous to
+    # pickle back from a worker process - only the counters are wanted.
+    counter.module_funcs = counter.charm_methods = None
     return counter
 
 
@@ -163,38 +211,40 @@ def walk_init(path):
 @click.command()
 def main(cache_folder):
     """Output simple statistics about the charm's __init__ code."""
-    FORMAT = "%(message)s"
-    logging.basicConfig(
-        level=logging.INFO,
-        format=FORMAT,
-        datefmt="[%X]",
-        handlers=[rich.logging.RichHandler()],
-    )
+    configure_logging()
 
-    total = 0
     calls = collections.Counter()
     calls_per_charm = collections.Counter()
     names = collections.Counter()
     raises = collections.Counter()
     asserts = collections.Counter()
     explicit_return = collections.Counter()
-    for entry in iter_entries(pathlib.Path(cache_folder)):
-        total += 1
-        counter = walk_init(entry)
-        if counter:
-            calls.update(counter.calls)
-            for call in counter.calls:
-                calls_per_charm[call] += 1
-            names.update(counter.names)
-            raises.update(counter.raises)
-            asserts.update(counter.asserts)
-            explicit_return.update(counter.explicit_return)
+    entries = list(iter_entries(pathlib.Path(cache_folder)))
+    total = len(entries)
+    init_cache = pathlib.Path(cache_folder) / ".init_cache"
+    init_cache.mkdir(parents=True, exist_ok=True)
+    # Parsing and walking the charms is CPU-bound and independent per charm,
+    # so fan it out across cores and merge the counters here.
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        for counter in executor.map(
+            walk_init, entries, itertools.repeat(str(init_cache)), chunksize=16
+        ):
+            if counter:
+                calls.update(counter.calls)
+                for call in counter.calls:
+                    calls_per_charm[call] += 1
+                names.update(counter.names)
+                raises.update(counter.raises)
+                asserts.update(counter.asserts)
+                explicit_return.update(counter.explicit_return)
 
     report(total, calls, calls_per_charm, names, raises, asserts, explicit_return)
 
 
 def report(total, calls, calls_per_charm, names, raises, asserts, explicit_return):
     """Output a report of the results to the console."""
+    import rich.console
+
     console = rich.console.Console()
     console.print()  # Separate out from any logging.
     console.print(f"Examined {total} charms.\n")
@@ -205,11 +255,7 @@ def report(total, calls, calls_per_charm, names, raises, asserts, explicit_retur
         "__init__ calls",
         "Function Name",
         total,
-        sorted(
-            [(k, v) for k, v in calls.items() if v > 0],
-            key=operator.itemgetter(1),
-            reverse=True,
-        ),
+        [(k, v) for k, v in calls.most_common() if v > 0],
     )
     console.print(table)
     console.print()
@@ -220,11 +266,7 @@ def report(total, calls, calls_per_charm, names, raises, asserts, explicit_retur
         "__init__ calls (per charm)",
         "Function Name",
         total,
-        sorted(
-            [(k, v) for k, v in calls_per_charm.items() if v > 2],
-            key=operator.itemgetter(1),
-            reverse=True,
-        ),
+        [(k, v) for k, v in calls_per_charm.most_common() if v > 2],
     )
     console.print(table)
     console.print()
@@ -234,11 +276,7 @@ def report(total, calls, calls_per_charm, names, raises, asserts, explicit_retur
         "__init__ assignment",
         "Name",
         total,
-        sorted(
-            [(k, v) for k, v in names.items() if v > 10],
-            key=operator.itemgetter(1),
-            reverse=True,
-        ),
+        [(k, v) for k, v in names.most_common() if v > 10],
     )
     console.print(table)
     console.print()
@@ -247,7 +285,7 @@ def report(total, calls, calls_per_charm, names, raises, asserts, explicit_retur
         "__init__ raises",
         "Name",
         total,
-        sorted(raises.items(), key=operator.itemgetter(1), reverse=True),
+        raises.most_common(),
     )
     console.print(table)
     console.print()
@@ -256,7 +294,7 @@ def report(total, calls, calls_per_charm, names, raises, asserts, explicit_retur
         "__init__ asserts",
         "Name",
         total,
-        sorted(asserts.items(), key=operator.itemgetter(1), reverse=True),
+        asserts.most_common(),
     )
     console.print(table)
     console.print()
@@ -269,7 +307,7 @@ def report(total, calls, calls_per_charm, names, raises, asserts, explicit_retur
         "__init__ explicit returns",
         "Return Value",
         total,
-        sorted(explicit_return.items(), key=operator.itemgetter(1), reverse=True),
+        explicit_return.most_common(),
     )
     console.print(table)
     console.print()
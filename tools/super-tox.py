@@ -3,18 +3,22 @@
 """Utility to bulk run tox commands across charm repositories."""
 
 import asyncio
+import collections
+import concurrent.futures
 import contextlib
 import dataclasses
+import functools
+import hashlib
 import itertools
 import logging
 import os
 import pathlib
-import pprint
 import re
 import shlex
 import shutil
 import subprocess
 import sys
+import tarfile
 from contextlib import nullcontext
 
 try:
@@ -52,6 +56,79 @@ class Settings:
 settings: Settings = None  # type: ignore
 
 
+# The files whose content determines what tox will install.
+_TOX_CACHE_INPUT_RE = re.compile(
+    r"^(?:tox\.ini|pyproject\.toml|requirements[\w.-]*\.(?:txt|in)|[\w.-]*-requirements\.txt)$"
+)
+
+
+def _tox_cache_key(repo: pathlib.Path):
+    """A digest of everything that determines the repo's tox environments.
+
+    The repo path is included because the virtualenvs under .tox embed
+    absolute paths, so an archive is only valid for the repo it came from.
+    The ops source and branch are included because the environments are
+    built while patch_ops has rewritten the on-disk files - the same
+    (unpatched) inputs with a different --ops-source produce different
+    environments.
+    """
+    try:
+        with os.scandir(repo) as entries:
+            names = sorted(
+                entry.name
+                for entry in entries
+                if entry.is_file(follow_symlinks=False)
+                and _TOX_CACHE_INPUT_RE.match(entry.name)
+            )
+    except FileNotFoundError:
+        return None
+    if not names:
+        return None
+    hasher = hashlib.sha256(
+        f"{sys.version}:{repo.resolve()}"
+        f":{settings.ops_source}:{settings.ops_source_branch}".encode()
+    )
+    for name in names:
+        hasher.update(name.encode())
+        hasher.update((repo / name).read_bytes())
+    return hasher.hexdigest()
+
+
+def _restore_tox_cache(repo: pathlib.Path, key: str):
+    """Extract a previously captured .tox folder, if one matches."""
+    if (repo / ".tox").exists():
+        return
+    archive = settings.cache_folder / ".tox-cache" / f"{key}.tar.gz"
+    try:
+        with tarfile.open(archive) as tar:
+            tar.extractall(repo)
+    except FileNotFoundError:
+        return
+    logger.info("Restored cached .tox for %s", repo)
+
+
+def _store_tox_cache(repo: pathlib.Path, key: str):
+    """Capture the repo's .tox folder so later runs skip the pip installs."""
+    tox_dir = repo / ".tox"
+    if not tox_dir.is_dir():
+        return
+    archive = settings.cache_folder / ".tox-cache" / f"{key}.tar.gz"
+    if archive.exists():
+        return
+    archive.parent.mkdir(parents=True, exist_ok=True)
+    tmp = archive.with_name(archive.name + ".tmp")
+    with tarfile.open(tmp, "w:gz") as tar:
+        tar.add(tox_dir, arcname=".tox")
+    os.replace(tmp, archive)
+    logger.info("Stored .tox cache for %s", repo)
+
+
+# The distribution name at the start of a requirements line - anything a
+# PEP 508 name can contain, so the match stops where the extras, specifier,
+# or marker begins.
+_REQUIREMENT_NAME_RE = re.compile(r"([A-Za-z0-9][A-Za-z0-9._-]*)")
+
+
 def _patch_requirements_file(requirements: pathlib.Path):
     """Replace a dependency in a requirements file and return the original
     content."""
@@ -88,14 +165,24 @@ def _patch_requirements_file(requirements: pathlib.Path):
                 )
                 adjusted.append(line)
                 continue
-            try:
-                req = packaging.requirements.Requirement(line)
-            except packaging.requirements.InvalidRequirement:
-                logger.error(
-                    "Unable to understand requirement %r in %s", line, requirements
-                )
-                continue
-            if req.name != "ops":
+            # Only the distribution name matters here, so pull it out with a
+            # regex rather than paying for a full Requirement parse of every
+            # line (marker and specifier grammar included). Lines the regex
+            # can't make sense of still go through packaging so that the
+            # invalid-requirement diagnostics are unchanged.
+            mo = _REQUIREMENT_NAME_RE.match(line)
+            if mo is None:
+                try:
+                    req = packaging.requirements.Requirement(line)
+                except packaging.requirements.InvalidRequirement:
+                    logger.error(
+                        "Unable to understand requirement %r in %s", line, requirements
+                    )
+                    continue
+                name = req.name
+            else:
+                name = mo[1]
+            if name.lower() != "ops":
                 adjusted.append(line)
     if settings.ops_source_branch:
         adjusted.append(f"\ngit+{settings.ops_source}@{settings.ops_source_branch}\n")
@@ -106,6 +193,35 @@ def _patch_requirements_file(requirements: pathlib.Path):
     return "".join(original)
 
 
+# The extra requirements files that may also pin ops: requirements-unit.txt,
+# test-requirements.txt, requirements*.in, and so on - but not
+# requirements.txt itself, which is patched separately.
+_EXTRA_REQUIREMENTS_RE = re.compile(
+    r"^(?:requirements-.*\.txt|.*-requirements\.txt|requirements.*\.in)$"
+)
+
+
+def _poetry_lock_cache_path(pyproject_text: str, lock_text: str | None):
+    """Where a lock generated for these exact inputs is persisted.
+
+    Keyed on the original pyproject and lock content plus the requested ops
+    source and branch, so any change to what poetry would resolve misses."""
+    digest = hashlib.sha256(
+        f"{settings.ops_source}:{settings.ops_source_branch}"
+        f":{pyproject_text}:{lock_text or ''}".encode()
+    ).hexdigest()
+    return settings.cache_folder / ".poetry-lock-cache" / f"{digest}.lock"
+
+
+# A poetry-style dependency line for ops (anchored, so "ops-x = ..." does
+# not match), and a PEP 621 dependency-list entry for ops ("ops", optional
+# extras, then a version specifier or nothing before the closing quote).
+_PYPROJECT_OPS_LINE_RE = re.compile(r"^([ \t]*)ops[ \t]*=.*$", re.M)
+_PYPROJECT_OPS_DEP_RE = re.compile(
+    r'^([ \t]*)"ops(?:\[[^]]*\])?[ \t]*(?:[<>=~!@][^"]*)?"([ \t]*,?)[ \t]*$', re.M
+)
+
+
 @contextlib.contextmanager
 def patch_ops(location: pathlib.Path):
     requirements = location / "requirements.txt"
@@ -118,12 +234,11 @@ def patch_ops(location: pathlib.Path):
         # dependency declarations matching the specified environment (or all
         # environments, if one isn't), but this seems sufficient for now.
         extras = {}
-        for fn in itertools.chain(
-            requirements.glob("requirements-*.txt"),  # e.g. requirements-unit.txt
-            requirements.glob("*-requirements.txt"),  # e.g. test-requirements.txt
-            requirements.glob("requirements*.in"),
-        ):
-            extras[fn] = _patch_requirements_file(fn)
+        with os.scandir(location) as entries:
+            for entry in entries:
+                if _EXTRA_REQUIREMENTS_RE.match(entry.name):
+                    fn = pathlib.Path(entry.path)
+                    extras[fn] = _patch_requirements_file(fn)
         try:
             yield requirements
         finally:
@@ -141,20 +256,49 @@ def patch_ops(location: pathlib.Path):
                 original_poetry_lock = data.read()
         else:
             original_poetry_lock = None
-        with pyproject.open("rb") as data:
-            adjusted = tomllib.load(data)
-        # TODO: Fix this so that something like ops-x" doesn't match.
-        adjusted["dependencies"] = [
-            req for req in adjusted.get("dependencies", ()) if not req.startswith("ops")
-        ]
         if settings.ops_source_branch:
             ops = f'{{ git = "{settings.ops_source}", branch = "{settings.ops_source_branch}" }}'
         else:
             ops = f'{{ git = "{settings.ops_source}" }}'
-        adjusted["dependencies"].append(f"\nops = {ops}")
-        # Some charms require running poetry lock after this change.
-        if "poetry" in adjusted.get("tool", {}):
-            subprocess.run(["poetry", "lock"], cwd=location, stdout=subprocess.PIPE)
+        # Line-targeted edits rather than a TOML round trip: the anchored
+        # patterns can't match the likes of "ops-x", only the lines of
+        # interest change, and the file actually gets the patched content
+        # written back (the parsed-dict version edited the dict and then
+        # never serialised it).
+        if settings.ops_source_branch:
+            ops_dep = f"ops @ git+{settings.ops_source}@{settings.ops_source_branch}"
+        else:
+            ops_dep = f"ops @ git+{settings.ops_source}"
+        adjusted = _PYPROJECT_OPS_LINE_RE.sub(rf"\g<1>ops = {ops}", original)
+        adjusted = _PYPROJECT_OPS_DEP_RE.sub(rf'\g<1>"{ops_dep}"\g<2>', adjusted)
+        # TODO: If the project doesn't declare ops at all, this leaves it
+        # undeclared - should the git version be inserted in that case?
+        with pyproject.open("w") as req:
+            req.write(adjusted)
+        # Some charms require running poetry lock after this change. A
+        # substring probe is enough to spot the table - no need to parse.
+        # Locking is the slowest step in the pipeline, and the original
+        # lock is restored after every run, so persist the generated lock
+        # keyed on its inputs and reuse it on repeat runs.
+        if "[tool.poetry]" in adjusted:
+            lock_cache = _poetry_lock_cache_path(original, original_poetry_lock)
+            try:
+                cached_lock = lock_cache.read_text()
+            except FileNotFoundError:
+                cached_lock = None
+            if cached_lock is not None:
+                logger.debug("Reusing a previously generated lock for %s", location)
+                with poetry_lock.open("w") as lock:
+                    lock.write(cached_lock)
+            else:
+                locked = subprocess.run(
+                    ["poetry", "lock"], cwd=location, stdout=subprocess.PIPE
+                )
+                if locked.returncode == 0 and poetry_lock.exists():
+                    lock_cache.parent.mkdir(parents=True, exist_ok=True)
+                    tmp = lock_cache.with_name(lock_cache.name + ".tmp")
+                    tmp.write_text(poetry_lock.read_text())
+                    os.replace(tmp, lock_cache)
         try:
             yield pyproject
         finally:
@@ -169,6 +313,47 @@ def patch_ops(location: pathlib.Path):
         )
 
 
+async def _git(
+    semaphore: asyncio.Semaphore, repo: pathlib.Path, *commands: tuple[str, ...]
+):
+    """Run git commands sequentially in the repository, logging any failure.
+
+    All the commands for one repository belong in a single call: as separate
+    tasks they would race on the repository's index lock, and the ordering
+    (checkout before pull) would be lost."""
+    async with semaphore:
+        for args in commands:
+            git = await asyncio.create_subprocess_exec(
+                "git",
+                *args,
+                cwd=repo.resolve(),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            out, err = await git.communicate()
+            command = shlex.join(["git", *args])
+            logger.debug("`%s` in %s: stdout %r, stderr: %s", command, repo, out, err)
+            if git.returncode != 0:
+                logger.error("`%s` in %s failed: %s", command, repo, err)
+
+
+_STREAM_CHUNK = 1 << 16
+
+
+async def _drain_stream(stream: asyncio.StreamReader, tail):
+    """Consume a subprocess stream, keeping a bounded tail (or nothing).
+
+    Fixed-size reads rather than readline: a single line longer than the
+    StreamReader's limit (pip progress output, for example) would make
+    readline raise mid-run, where communicate() coped with anything."""
+    while True:
+        chunk = await stream.read(_STREAM_CHUNK)
+        if not chunk:
+            return
+        if tail is not None:
+            tail.append(chunk)
+
+
 async def run_tox(
     executable: str,
     location: pathlib.Path,
@@ -188,8 +373,20 @@ async def run_tox(
             stderr=asyncio.subprocess.PIPE,
             cwd=location.resolve(),
         )
-        stdout, stderr = await tox.communicate()
-        returncode = tox.returncode
+        # Stream the output rather than communicate(): stdout is dropped as
+        # it arrives (it's so verbose that it just pollutes the log - it's
+        # simpler to re-run tox manually in that repo to get the output;
+        # TODO: there must be a better solution, like sending it somewhere
+        # it can be accessed in a handy format?) and only a bounded tail of
+        # stderr (the last few MiB) is kept, so a chatty suite no longer
+        # holds its whole output in memory per worker.
+        stderr_tail = collections.deque(maxlen=64)
+        await asyncio.gather(
+            _drain_stream(tox.stdout, None),
+            _drain_stream(tox.stderr, stderr_tail),
+        )
+        returncode = await tox.wait()
+        stderr = b"".join(stderr_tail)
     else:
         # TODO: Handle: config, cache folder, ops patching (higher than this!), fresh tox, lxd name, image alias, keeping instance
         # Provide a partial to the method.
@@ -197,16 +394,8 @@ async def run_tox(
             f"{settings.lxd_name}-{location.name}",
             delete_on_exit=not settings.keep_lxd_instance,
         ) as lxd:
-            returncode, stdout, stderr = lxd.execute(args)
+            returncode, _stdout, stderr = lxd.execute(args)
     if returncode != 0:
-        if stdout.strip():
-            # This is potentially useful, but it's so verbose that it just
-            # pollutes the log. It's simpler to just re-run tox manually in that
-            # repo to get the output.
-            # TODO: There must be a better solution here, like sending it to
-            # somewhere it can be accessed in a handy format?
-            # logger.info("tox failed:%s in %s: %r", environment, location, stdout)
-            pass
         if stderr.strip():
             logger.error("Errors from tox:%s in %s: %r", environment, location, stderr)
     # TODO: Should do more than this - does everything have a coverage report?
@@ -224,114 +413,96 @@ async def run_tox(
 async def super_tox(conf, environment: str):
     """Run `tox -e {environment}` in each repository's folder."""
     results = []
-    queue = asyncio.Queue()
-    end = settings.sample or sys.maxsize
-    for repo in itertools.islice(settings.cache_folder.iterdir(), 0, end):
-        if not re.match(settings.repo_re, repo.name, re.IGNORECASE):
-            logger.info("Skipping %s - doesn't match specified pattern", repo)
-            continue
-        if not (repo / "tox.ini").exists():
-            continue
-        if settings.fresh_tox:
-            tox_cache = repo / ".tox"
-            if tox_cache.exists():
-                shutil.rmtree(str(tox_cache))
-        if settings.remove_local_changes:
-            git = subprocess.Popen(
-                ["git", "checkout", "."],
-                cwd=repo.resolve(),
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-            out, err = git.communicate()
-            logger.debug(
-                "`git checkout .` in %s: stdout %r, stderr: %s", repo, out, err
-            )
-            if git.returncode != 0:
-                logger.error("`git checkout .` in %s failed.", repo)
-        # Unlike `checkout .`, `pull` connects to the remote, so it might be
-        # better to put this in the async worker, rather than blocking starting
-        # off all the jobs to do it. Alternatively, maybe get rid of this option
-        # and just make use of `tools/get_charms.py`, which already knows how to
-        # do this very quickly.
-        if settings.git_pull:
-            git = subprocess.Popen(
-                ["git", "pull"],
-                cwd=repo.resolve(),
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-            )
-            out, err = git.communicate()
-            logger.debug("`git pull` in %s: stdout %r, stderr: %s", repo, out, err)
-            if git.returncode != 0:
-                logger.error("`git pull` in %s failed: %s", repo, err)
-        queue.put_nowait((repo, environment, results))
-
-    tasks = []
-    for i in range(settings.workers):
-        task = asyncio.create_task(worker(f"worker-{i}", queue, conf))
-        tasks.append(task)
-    await queue.join()
-    for task in tasks:
-        task.cancel()
-
-    await asyncio.gather(*tasks)
-    results.sort(key=lambda d: d["location"])
-    success_count = 0
-
-    for result in results:
-        try:
-            if not result["passed"]:
+    repos_to_run = []
+    end = settings.sample or None
+    # Cleaning and pulling the repositories used to run as blocking
+    # subprocesses, one repo at a time, before any tox work started; run
+    # them concurrently (bounded, so a huge cache doesn't exhaust process
+    # slots) and the prelude takes as long as the slowest remote.
+    git_semaphore = asyncio.Semaphore(32)
+    prep = []
+    # Compile the filter once, not once per directory entry, and enumerate
+    # with scandir: the name check and the tox.ini probe then run before
+    # any Path object is built for rejected entries.
+    repo_re = re.compile(settings.repo_re, re.IGNORECASE)
+    with os.scandir(settings.cache_folder) as folder_entries:
+        for entry in itertools.islice(folder_entries, end):
+            if not repo_re.match(entry.name):
+                logger.info("Skipping %s - doesn't match specified pattern", entry.path)
+                continue
+            if not os.path.exists(os.path.join(entry.path, "tox.ini")):
                 continue
-        # FIXME these exceptions never happen...
-        except (TypeError, asyncio.CancelledError) as e:
-            logger.error("Task was cancelled: %s", e, exc_info=True)
-            continue
-        except Exception as e:
-            logger.error("Unable to process result: %s", e, exc_info=True)
-            continue
-        success_count += 1
+            repo = pathlib.Path(entry.path)
+            if settings.fresh_tox:
+                tox_cache = repo / ".tox"
+                if tox_cache.exists():
+                    shutil.rmtree(str(tox_cache))
+            commands = []
+            if settings.remove_local_changes:
+                commands.append(("checkout", "."))
+            # Alternatively, maybe get rid of this option and just make use of
+            # `tools/get_charms.py`, which already knows how to do this very
+            # quickly.
+            if settings.git_pull:
+                commands.append(("pull",))
+            if commands:
+                prep.append(_git(git_semaphore, repo, *commands))
+            repos_to_run.append(repo)
+    if prep:
+        await asyncio.gather(*prep)
+
+    # A semaphore bounds the concurrency instead of long-lived workers
+    # pulling from a queue: there is no cancellation dance at the end (which
+    # masked worker exceptions - hence the old FIXME about exceptions that
+    # never happened), and any failure surfaces from the gather.
+    # Invert the ignore configuration once: location -> reason replaces a
+    # membership test per category per repo.
+    reasons = {
+        location: _IGNORE_MESSAGES.get(category, category)
+        for category, locations in conf.get("ignore", {}).items()
+        for location in locations
+    }
+    semaphore = asyncio.Semaphore(settings.workers)
+    await asyncio.gather(
+        *(
+            _process_repo(semaphore, repo, environment, results, reasons)
+            for repo in repos_to_run
+        )
+    )
+    results.sort(key=lambda d: d["location"])
+    success_count = sum(1 for result in results if result["passed"])
     pct = 100 * success_count // len(results)
     print(f"{success_count} out of {len(results)} ({pct}%) runs passed.")
     if settings.verbose:
         print("Failed for these repos:")
-        pprint.pprint([
-            str(d["location"].relative_to(settings.cache_folder))
-            for d in results
-            if not d["passed"]
-        ])
+        # One joined write - pprint re-sorts and measures every entry in
+        # pure Python, which drags at the tail of a long run.
+        print(
+            "\n".join(
+                str(d["location"].relative_to(settings.cache_folder))
+                for d in results
+                if not d["passed"]
+            )
+        )
 
 
-async def worker(name, queue, conf):
-    logger.info("Starting worker: %s", name)
-    ignore = conf.get("ignore", {})
-    while True:
-        try:
-            repo, environment, results = await queue.get()
-        except asyncio.CancelledError:
-            # We don't need to do anything any more.
-            break
+# Why each category of the configured ignore list is skipped.
+_IGNORE_MESSAGES = {
+    "expensive": "too expensive",
+    "manual": "requires manual intervention",
+    "requirements": "cannot install dependencies",
+    "not_ops": "does not use ops",
+    "misc": "in misc ignore list",
+}
+
+
+async def _process_repo(semaphore, repo, environment, results, reasons):
+    """Run tox for one repository (or each charm inside a bundle)."""
+    async with semaphore:
         location = str(repo.relative_to(settings.cache_folder))
-        if location in ignore.get("expensive", ()):
-            logger.info("Skipping %r - too expensive", location)
-            queue.task_done()
-            continue
-        elif location in ignore.get("manual", ()):
-            logger.info("Skipping %r - requires manual intervention", location)
-            queue.task_done()
-            continue
-        elif location in ignore.get("requirements", ()):
-            logger.info("Skipping %r - cannot install dependencies", location)
-            queue.task_done()
-            continue
-        elif location in ignore.get("not_ops", ()):
-            logger.info("Skipping %r - does not use ops", location)
-            queue.task_done()
-            continue
-        elif location in ignore.get("misc", ()):
-            logger.info("Skipping %r - in misc ignore list", location)
-            queue.task_done()
-            continue
+        if location in reasons:
+            logger.info("Skipping %r - %s", location, reasons[location])
+            return
 
         if (
             (repo / "bundle.yaml").exists()
@@ -351,16 +522,49 @@ async def worker(name, queue, conf):
             if repo.name == "catalogue-k8s-operator":
                 repo = repo / "charm"
             location = str(repo.relative_to(settings.cache_folder))
-            if location in sum(ignore.values(), []):
-                logger.info("Skipping %r", location)
+            if location in reasons:
+                logger.info("Skipping %r - %s", location, reasons[location])
                 continue
             if settings.mode == "local":
+                # Rebuilding identical environments is the expensive part of
+                # a run, so archive .tox keyed on the files that determine
+                # it (off the event loop - the tarballs can be large).
+                # --fresh-tox still forces a from-scratch build.
+                key = _tox_cache_key(repo)
+                if key is not None and not settings.fresh_tox:
+                    await asyncio.to_thread(_restore_tox_cache, repo, key)
+                # run_tox appends into a local list so that the store
+                # decision below only sees this repo's outcomes - other
+                # repos append to the shared list during the await.
+                repo_results = []
                 try:
                     with patch_ops(repo) if settings.ops_source else nullcontext():
-                        await run_tox(settings.executable, repo, environment, results)
+                        await run_tox(
+                            settings.executable, repo, environment, repo_results
+                        )
                 except Exception as e:
                     logger.error("Failed running tox: %s", e, exc_info=True)
-        queue.task_done()
+                else:
+                    # Only capture environments from a passing run - a failure
+                    # may mean the installs themselves went wrong, and the
+                    # archive would pin that broken state for this key.
+                    if key is not None and all(
+                        result["passed"] for result in repo_results
+                    ):
+                        await asyncio.to_thread(_store_tox_cache, repo, key)
+                finally:
+                    results.extend(repo_results)
+
+
+@functools.lru_cache(maxsize=1)
+def _lxd_client():
+    """The local LXD client, created once.
+
+    Constructing a Client probes the socket and negotiates the API on every
+    call, so share a single instance across the run."""
+    import pylxd  # type: ignore
+
+    return pylxd.Client()
 
 
 def get_lxd_instance(name: str, image_alias: str, create: bool = False):
@@ -370,7 +574,7 @@ def get_lxd_instance(name: str, image_alias: str, create: bool = False):
     using the provided image alias."""
     import pylxd  # type: ignore
 
-    client = pylxd.Client()
+    client = _lxd_client()
     try:
         return client.instances.get(name)
     except pylxd.exceptions.NotFound:
@@ -386,21 +590,85 @@ def lxd_exists(instance, filename: str) -> bool:
     return instance.execute(["stat", filename]).exit_code == 0
 
 
-def sync_to_lxd(instance, source: pathlib.Path, destination: str):
-    """Recursively copy the source to the destination inside of the instance."""
+def _tree_version(path: pathlib.Path) -> str:
+    """A token identifying the current state of the checkout.
+
+    Uncommitted changes are mixed in via a digest of the status and diff, so
+    that iterating on local edits (the --keep-lxd-instance workflow) still
+    gets them synced to a kept instance."""
+    git = subprocess.run(
+        ["git", "rev-parse", "HEAD"],
+        cwd=path,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    if git.returncode != 0:
+        return "unknown"
+    head = git.stdout.decode().strip()
+    status = subprocess.run(
+        ["git", "status", "--porcelain"],
+        cwd=path,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    if status.returncode != 0 or status.stdout.strip():
+        diff = subprocess.run(
+            ["git", "diff", "HEAD"],
+            cwd=path,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        dirty = hashlib.sha256(status.stdout + diff.stdout).hexdigest()[:16]
+        return f"{head}-{dirty}"
+    return head
+
+
+def _sync_item(instance, path: str, is_file: bool, destination: str):
+    """Copy one file or folder into the instance (runs in a pool thread)."""
     # TODO: This assumes that there aren't edges cases like the path exists
     # in the instance, but it's a file there and a directory locally.
-    for item in source.iterdir():
-        item_destination = os.path.join(destination, item.name)
-        if not lxd_exists(instance, str(item)):
-            # We can just copy it.
-            instance.files.recursive_put(str(item), item_destination)
-        elif item.is_file():
-            # If it's a file, we can just replace it.
-            instance.files.delete(item_destination)
-            instance.files.put(str(item), item_destination)
-        else:
-            sync_to_lxd(instance, item, item_destination)
+    if not lxd_exists(instance, path):
+        # We can just copy it.
+        instance.files.recursive_put(path, destination)
+    elif is_file:
+        # If it's a file, we can just replace it.
+        instance.files.delete(destination)
+        instance.files.put(path, destination)
+    else:
+        # scandir's DirEntry objects carry the dirent type from the
+        # directory read, so the is_file check costs no extra stat syscall.
+        with os.scandir(path) as entries:
+            for item in entries:
+                _sync_item(
+                    instance,
+                    item.path,
+                    item.is_file(follow_symlinks=False),
+                    os.path.join(destination, item.name),
+                )
+
+
+def sync_to_lxd(instance, source, destination: str):
+    """Recursively copy the source to the destination inside of the instance.
+
+    Each item costs at least two HTTPS round trips to the LXD API (the
+    existence probe and the put), and the items are independent, so fan
+    the top level out over a small thread pool (pylxd is synchronous, but
+    its session handles concurrent requests) rather than issuing
+    thousands of serial calls.
+    """
+    with os.scandir(source) as entries:
+        items = [
+            (
+                item.path,
+                item.is_file(follow_symlinks=False),
+                os.path.join(destination, item.name),
+            )
+            for item in entries
+        ]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as pool:
+        futures = [pool.submit(_sync_item, instance, *item) for item in items]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
 
 
 @contextlib.contextmanager
@@ -413,13 +681,21 @@ def lxd_instance(name: str, *, delete_on_exit: bool = True):
         # TODO: Ideally, the two copies would really be syncs, to speed things
         # up when the instance already exists, but without missing any changes
         # since the initial copy.
-        logger.info("Copying charm-analysis to the instance")
         me = pathlib.Path(__file__).parent.parent
-        sync_to_lxd(instance, me, "charm-analysis")
-        # Copy the cache to the instance.
-        if not settings.cache_folder.is_relative_to(me):
-            logger.info("Copying cache to the instance")
-            sync_to_lxd(instance, settings.cache_folder, "charm-analysis/.cache")
+        # A marker keyed on the commit (and any uncommitted changes) lets a
+        # kept instance skip the bulk copy entirely - the common case when
+        # iterating with --keep-lxd-instance.
+        marker = f"charm-analysis/.synced-{_tree_version(me)}"
+        if lxd_exists(instance, marker):
+            logger.info("Instance already has this charm-analysis tree")
+        else:
+            logger.info("Copying charm-analysis to the instance")
+            sync_to_lxd(instance, me, "charm-analysis")
+            # Copy the cache to the instance.
+            if not settings.cache_folder.is_relative_to(me):
+                logger.info("Copying cache to the instance")
+                sync_to_lxd(instance, settings.cache_folder, "charm-analysis/.cache")
+            instance.files.put(marker, b"")
         yield instance
     finally:
         if instance.status == "Running":